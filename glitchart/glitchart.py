@@ -21,15 +21,28 @@
 # SOFTWARE.
 
 import asyncio
+import io
 import logging
+import mmap
 import os
+import shutil
 import subprocess
+import traceback
+from collections import deque
+from concurrent.futures import Executor
+from functools import partial
 from pathlib import Path
-from random import Random
 from uuid import uuid4
 
+import numpy as np
 from PIL import Image
 
+try:
+    from numba import njit
+except ImportError:  # Numba is optional, without it the glitch kernel simply runs as plain Python
+    def njit(*args, **kwargs):
+        return lambda func: func
+
 MIN_AMOUNT_IMAGE = 1
 MAX_AMOUNT_IMAGE = 10
 
@@ -44,9 +57,66 @@ EOI = b"\xFF\xD9"  # End Of Image
 
 OUT_NAME_TEMPLATE = "{}_glitch.{}"
 
+PIPE_CHUNK_SIZE = 1024 * 1024
+
 log = logging.getLogger(__name__)
 
 
+def _scan_bounds(buf) -> tuple:
+    """Return the (start, end) offsets of the scan data of a JPEG image, which is the part worth glitching.
+    buf can be any buffer with find() and rfind() methods, such as bytes, bytearray or mmap.
+    """
+    sos = buf.find(SOS)
+    end = buf.rfind(EOI)
+
+    if sos < 0 or end < 0:
+        raise ValueError("Not a valid JPEG image: SOS or EOI marker not found")
+
+    start = sos + len(SOS) + 10
+
+    if start > end:
+        raise ValueError("Not a valid JPEG image: EOI marker found inside the SOS header")
+
+    return start, end
+
+
+@njit(cache=True)
+def _glitch_kernel(data, chosen, indices, values, amount):
+    """Corrupt up to amount bytes of data in-place and return how many were actually corrupted.
+
+    Positions are picked in order from indices, skipping 0x00/0xFF bytes and those already marked in the chosen
+    bitmap. New values are taken in order from values, which must be in range [1, 253], and are shifted to always
+    differ from the bytes they replace.
+    """
+    count = 0
+
+    for i in range(indices.size):
+        if count == amount:
+            break
+
+        index = indices[i]
+        byte = data[index]
+
+        if chosen[index] or byte == 0 or byte == 255:
+            continue
+
+        chosen[index] = 1
+
+        value = values[count]
+
+        if value >= byte:
+            value += 1  # Skip over byte: no retries and still evenly spread over the other values in [1, 254]
+
+        data[index] = value
+        count += 1
+
+    return count
+
+
+# Compile the kernel once at import time (Numba caches it on disk) so the first glitch doesn't pay for it
+_glitch_kernel(np.ones(16, np.uint8), np.zeros(16, np.uint8), np.arange(16), np.ones(16, np.uint8), 1)
+
+
 def jpeg(photo: str,
          seed: int = None,
          min_amount: int = MIN_AMOUNT_IMAGE,
@@ -61,8 +131,9 @@ def jpeg(photo: str,
             Pass a file path as string to glitch a photo that exists on your local machine.
 
         seed (int, optional):
-            Pseudo-random number generator seed.
-            Using again the same seed on the original file will result in identical glitched images.
+            Pseudo-random number generator seed, must be an integer.
+            Using again the same seed on the original file will result in identical glitched images, as long as the
+            same major version of GlitchArt is used: seeds are not reproducible across major versions.
             Defaults to a random value.
 
         min_amount (int, optional):
@@ -88,8 +159,55 @@ def jpeg(photo: str,
         On success, the absolute path of the glitched image is returned.
     """
     out = photo if inplace else OUT_NAME_TEMPLATE.format(Path(photo).stem, "jpg")
-    prng = Random(seed)
 
+    if not inplace:
+        # Let the OS copy the file (e.g.: with sendfile on Linux), then glitch the copy in-place
+        shutil.copyfile(photo, out)
+
+    try:
+        # Map the file instead of reading it: only the pages that get searched or glitched are actually read from
+        # disk, and only those that change are written back
+        with open(out, "r+b") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE) as mm:
+            _glitch(mm, seed, *_amounts(min_amount, max_amount))
+    except BaseException:  # Also on KeyboardInterrupt: don't leave a half-glitched copy behind
+        if not inplace:
+            os.remove(out)
+
+        raise
+
+    return Path(out).absolute()
+
+
+def _jpeg_bytes(buf: bytes,
+                seed: int = None,
+                min_amount: int = MIN_AMOUNT_IMAGE,
+                max_amount: int = MAX_AMOUNT_IMAGE) -> bytearray:
+    """Glitch a JPEG image held in memory and return a glitched copy of it. See jpeg() for the arguments.
+
+    The amounts are expected to be fixed up already by _amounts(), so that callers glitching many images in a row
+    (e.g.: video frames) only do it once.
+    """
+    buf = bytearray(buf)
+    _glitch(buf, seed, min_amount, max_amount)
+
+    return buf
+
+
+def _rng(seed: int) -> np.random.Generator:
+    """Return a PCG64-backed generator for seed. As with random.Random, negative seeds act as their absolute value."""
+    if seed is not None and not isinstance(seed, int):
+        raise TypeError("seed must be an int, not {}".format(type(seed).__name__))
+
+    return np.random.default_rng(None if seed is None else abs(seed))
+
+
+def _frame_seed(rng: np.random.Generator) -> int:
+    """Draw the seed of the next video frame."""
+    return int(rng.integers(MIN_SEED, MAX_SEED, endpoint=True))
+
+
+def _amounts(min_amount: int, max_amount: int) -> tuple:
+    """Return min_amount and max_amount fixed up as described in jpeg()."""
     if min_amount < 0:
         min_amount = 0
 
@@ -99,45 +217,73 @@ def jpeg(photo: str,
     if min_amount > max_amount:
         max_amount = min_amount
 
-    amount = prng.randint(min_amount, max_amount)
+    return min_amount, max_amount
 
-    with open(photo, "rb") as f:
-        original = f.read()
 
-        start = original.index(SOS) + len(SOS) + 10
-        end = original.rindex(EOI)
+def _glitch(buf, seed: int, min_amount: int, max_amount: int):
+    """Glitch the JPEG image in buf in-place. buf can be any writable buffer that _scan_bounds() accepts.
+    The amounts are expected to be fixed up already by _amounts().
+    """
+    rng = _rng(seed)
 
-        data = bytearray(original[start:end])
-        glitched = set()
+    amount = int(rng.integers(min_amount, max_amount, endpoint=True))
 
-        for _ in range(amount):
-            while True:
-                index = prng.randrange(len(data))
+    start, end = _scan_bounds(buf)
 
-                if index not in glitched:
-                    if data[index] not in [0, 255]:
-                        glitched.add(index)
-                        break
+    arr = np.frombuffer(buf, dtype=np.uint8, count=end - start, offset=start)  # Zero-copy view of the scan data
 
-            while True:
-                value = prng.randint(1, 254)
+    # arr exports buf: it must be gone before buf is released (e.g.: an mmap being closed), also when failing,
+    # otherwise closing raises BufferError and hides the actual error
+    try:
+        if amount == 0 or arr.size == 0:
+            return
 
-                if data[index] != value:
-                    data[index] = value
-                    break
+        chosen = np.zeros(arr.size, dtype=np.uint8)  # Bitmap of the positions already glitched
 
-    with open(out, "wb") as f:
-        f.write(
-            original[:start]
-            + data
-            + original[end:]
-        )
+        # Random positions are good picks almost every time, 0x00 and 0xFF bytes are a minority in scan data
+        indices = rng.integers(0, arr.size, size=amount * 4)
+        values = rng.integers(1, 254, size=amount, dtype=np.uint8)
 
-    return Path(out).absolute()
+        glitched = _glitch_kernel(arr, chosen, indices, values, amount)
+
+        if glitched < amount:
+            # Unlucky draws or scan data made mostly of 0x00 and 0xFF bytes. Pick among the eligible positions that
+            # are left instead of drawing again: this bounds the work to a single pass over the data
+            eligible = np.flatnonzero((arr != 0) & (arr != 255) & (chosen == 0))
+            indices = rng.choice(eligible, size=min(amount - glitched, eligible.size), replace=False)
+
+            glitched += _glitch_kernel(arr, chosen, indices, values[glitched:], indices.size)
+    except BaseException as e:
+        traceback.clear_frames(e.__traceback__)  # Frames below this one may still hold arr
+        raise
+    finally:
+        del arr
 
 
 async def jpeg_async(*args, **kwargs):
-    return jpeg(*args, **kwargs)
+    # Run in a worker thread, glitching would otherwise block the event loop until done
+    return await asyncio.get_event_loop().run_in_executor(None, partial(jpeg, *args, **kwargs))
+
+
+def _glitch_image(image: Image.Image,
+                  seed: int = None,
+                  min_amount: int = MIN_AMOUNT_IMAGE,
+                  max_amount: int = MAX_AMOUNT_IMAGE) -> Image.Image:
+    """Glitch an image of any format by round-tripping it through an in-memory JPEG. See jpeg() for the arguments."""
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        image = image.convert("RGBA")
+
+        bg = Image.new("RGB", image.size, (255, 255, 255))
+        bg.paste(image, image)
+    else:  # Opaque already, flattening it onto a white background would just copy the pixels around
+        bg = image.convert("RGB")
+
+    jpg = io.BytesIO()
+    bg.save(jpg, "JPEG")
+
+    glitched = _jpeg_bytes(jpg.getbuffer(), seed, *_amounts(min_amount, max_amount))
+
+    return Image.open(io.BytesIO(glitched)).convert("RGBA")
 
 
 def png(photo: str,
@@ -146,25 +292,14 @@ def png(photo: str,
         max_amount: int = MAX_AMOUNT_IMAGE,
         inplace: bool = False):
     out = photo if inplace else OUT_NAME_TEMPLATE.format(Path(photo).stem, "png")
-    jpg_path = "{}.jpg".format(uuid4())
-
-    png = Image.open(photo).convert("RGBA")
-
-    bg = Image.new("RGB", png.size, (255, 255, 255))
-    bg.paste(png, png)
-    bg.save(jpg_path)
 
-    jpeg(jpg_path, seed, min_amount, max_amount, True)
-
-    Image.open(jpg_path).convert("RGBA").save(out)
-
-    os.remove(jpg_path)
+    _glitch_image(Image.open(photo), seed, min_amount, max_amount).save(out)
 
     return Path(out).absolute()
 
 
 async def png_async(*args, **kwargs):
-    return png(*args, **kwargs)
+    return await asyncio.get_event_loop().run_in_executor(None, partial(png, *args, **kwargs))
 
 
 def webp(photo: str,
@@ -173,117 +308,141 @@ def webp(photo: str,
          max_amount: int = MAX_AMOUNT_IMAGE,
          inplace: bool = False):
     out = photo if inplace else OUT_NAME_TEMPLATE.format(Path(photo).stem, "webp")
-    png_path = "{}.png".format(uuid4())
 
-    webp = Image.open(photo)
-    webp.save(png_path)
+    _glitch_image(Image.open(photo), seed, min_amount, max_amount).save(out)
 
-    png(png_path, seed, min_amount, max_amount, True)
+    return Path(out).absolute()
 
-    Image.open(png_path).save(out)
 
-    os.remove(png_path)
+async def webp_async(*args, **kwargs):
+    return await asyncio.get_event_loop().run_in_executor(None, partial(webp, *args, **kwargs))
 
-    return Path(out).absolute()
 
+def _fps(video: str) -> str:
+    """Return the frame rate of a video as reported by ffprobe. E.g.: "30000/1001"."""
+    return subprocess.check_output(
+        ["ffprobe", "-v", "error", "-select_streams", "v", "-of", "default=noprint_wrappers=1:nokey=1",
+         "-show_entries", "stream=r_frame_rate", video]
+    ).strip().decode()
 
-async def webp_async(*args, **kwargs):
-    return webp(*args, **kwargs)
+
+def _mjpeg_frames(stream):
+    """Split an MJPEG stream into the JPEG images it is made of."""
+    buf = bytearray()
+    offset = 0
+
+    while True:
+        end = buf.find(EOI, offset)
+
+        if end < 0:
+            chunk = stream.read(PIPE_CHUNK_SIZE)
+
+            if not chunk:
+                break
+
+            offset = max(len(buf) - len(EOI) + 1, 0)  # An EOI could be split between two chunks
+            buf += chunk
+            continue
+
+        end += len(EOI)
+
+        with memoryview(buf) as view:  # Copy the frame out once, slicing the bytearray itself would copy it twice
+            frame = bytes(view[:end])
+
+        yield frame
+
+        del buf[:end]
+        offset = 0
 
 
 def mp4(video: str,
         seed: int = None,
         min_amount: int = MIN_AMOUNT_VIDEO,
         max_amount: int = MAX_AMOUNT_VIDEO,
-        inplace: bool = False):
+        inplace: bool = False,
+        executor: Executor = None):
+    """Glitch an MP4 video by glitching each of its frames as a JPEG image. See jpeg() for the common arguments,
+    the amounts apply to each frame and default to [0, 3].
+
+    Args:
+        executor (concurrent.futures.Executor, optional):
+            Executor to glitch frames on, e.g.: a ProcessPoolExecutor to use more cores on long videos with high
+            amounts. Glitching a frame is usually cheaper than sending it to another process, so frames are glitched
+            one after the other in the calling thread by default.
+    """
     out = video if inplace else OUT_NAME_TEMPLATE.format(Path(video).stem, "mp4")
-    uuid = uuid4()
+    min_amount, max_amount = _amounts(min_amount, max_amount)
+    # The video is read while the glitched one is being written, don't overwrite it until the end
+    tmp = str(Path(video).with_name("{}.mp4".format(uuid4()))) if inplace else out
 
     try:
-        fps = subprocess.check_output(
-            "ffprobe -v error -select_streams v -of "
-            "default=noprint_wrappers=1:nokey=1 -show_entries stream=r_frame_rate {video}".format(
-                video=video
-            ),
-            shell=True
-        ).strip().decode()
-
-        os.system(
-            "ffmpeg -loglevel quiet -i {video} {uuid}_%8d.jpg".format(
-                video=video,
-                uuid=uuid
-            )
+        if max_amount == 0:  # No frame would be glitched, just remux the video
+            if not inplace:
+                subprocess.run(["ffmpeg", "-loglevel", "quiet", "-y", "-i", video, "-c", "copy", out], check=True)
+
+            return Path(out).absolute()
+
+        fps = _fps(video)
+
+        if executor is not None:
+            # Have the executor start its workers before any pipe is opened: forked workers would otherwise inherit
+            # the encoder's stdin and keep it open, so that the encoder would never see the end of the stream
+            executor.submit(int).result()
+
+        # Frames flow as an MJPEG stream from one ffmpeg to the other, nothing is written to disk in between.
+        # Passthrough sync makes one image per decoded frame, with no duplicates or drops, so that frames and the
+        # seeds they get always line up with the video
+        decoder = subprocess.Popen(
+            ["ffmpeg", "-loglevel", "quiet", "-i", video, "-vsync", "0", "-f", "image2pipe", "-vcodec", "mjpeg", "-"],
+            stdout=subprocess.PIPE,
+            bufsize=0
         )
 
-        prng = Random(seed)
-
-        for p in sorted(Path().rglob(f"{uuid}_*.jpg")):
-            jpeg(str(p), prng.getrandbits(2500), min_amount, max_amount, inplace=True)
-
-        os.system(
-            "ffmpeg -loglevel quiet -r {fps} -i {uuid}_%8d.jpg {out} -y".format(
-                fps=fps,
-                uuid=uuid,
-                out=out
-            )
+        encoder = subprocess.Popen(
+            ["ffmpeg", "-loglevel", "quiet", "-y", "-r", fps, "-f", "image2pipe", "-vcodec", "mjpeg", "-i", "-",
+             tmp],
+            stdin=subprocess.PIPE  # Buffered: unlike raw pipe writes, a frame is always written whole
         )
-    except Exception as e:
-        log.error(e)
-    finally:
-        for p in Path().rglob(f"{uuid}_*.jpg"):
-            try:
-                os.remove(str(p))
-            except OSError:
-                pass
 
-    return Path(out).absolute()
+        prng = _rng(seed)
+        glitch = partial(_jpeg_bytes, min_amount=min_amount, max_amount=max_amount)  # Same amounts for every frame
 
+        with decoder, encoder:
+            frames = _mjpeg_frames(decoder.stdout)
 
-async def mp4_async(video: str,
-                    seed: int = None,
-                    min_amount: int = MIN_AMOUNT_VIDEO,
-                    max_amount: int = MAX_AMOUNT_VIDEO,
-                    inplace: bool = False):
-    out = video if inplace else OUT_NAME_TEMPLATE.format(Path(video).stem, "mp4")
-    uuid = uuid4()
+            if executor is None:
+                for frame in frames:
+                    encoder.stdin.write(glitch(frame, _frame_seed(prng)))
+            else:
+                # Keep a few frames in flight to feed the executor, and write them back in order
+                max_pending = 2 * (os.cpu_count() or 1)
+                pending = deque()
 
-    try:
-        fps = subprocess.check_output(
-            "ffprobe -v error -select_streams v -of "
-            "default=noprint_wrappers=1:nokey=1 -show_entries stream=r_frame_rate {video}".format(
-                video=video
-            ),
-            shell=True
-        ).strip().decode()
-
-        process = await asyncio.create_subprocess_shell(
-            "ffmpeg -loglevel quiet -i {video} {uuid}_%8d.jpg".format(
-                video=video,
-                uuid=uuid
-            )
-        )
-        await process.wait()
+                for frame in frames:
+                    pending.append(executor.submit(glitch, frame, _frame_seed(prng)))
 
-        prng = Random(seed)
+                    if len(pending) >= max_pending:
+                        encoder.stdin.write(pending.popleft().result())
 
-        for p in sorted(Path().rglob(f"{uuid}_*.jpg")):
-            jpeg(str(p), prng.randint(MIN_SEED, MAX_SEED), min_amount, max_amount, inplace=True)
+                while pending:
+                    encoder.stdin.write(pending.popleft().result())
 
-        process = await asyncio.create_subprocess_shell(
-            "ffmpeg -loglevel quiet -r {fps} -i {uuid}_%8d.jpg {out} -y".format(
-                fps=fps,
-                uuid=uuid,
-                out=out
-            )
-        )
-        await process.wait()
-    except Exception as e:
-        log.error(e)
+        # A failed decode or encode leaves a truncated video behind, it must never replace the original one
+        for process in (decoder, encoder):
+            if process.returncode:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+
+        if inplace:
+            os.replace(tmp, out)
     finally:
-        for p in Path().rglob("{uuid}_*.jpg".format(uuid=uuid)):
+        if inplace:
             try:
-                os.remove(str(p))
+                os.remove(tmp)
             except OSError:
                 pass
 
     return Path(out).absolute()
+
+
+async def mp4_async(*args, **kwargs):
+    return await asyncio.get_event_loop().run_in_executor(None, partial(mp4, *args, **kwargs))
@@ -30,7 +30,7 @@ def read(file: str) -> list:
 
 setup(
     name="GlitchArt",
-    version="1.0.0",
+    version="2.0.0",
     description="Media Glitch Library for Python",
     url="https://github.com/delivrance/glitchart",
     author="Dan Tès",
@@ -66,5 +66,8 @@ setup(
     python_requires="~=3.4",
     packages=["glitchart"],
     zip_safe=False,
-    install_requires=read("requirements.txt")
+    install_requires=read("requirements.txt"),
+    extras_require={
+        "fast": ["numba"]
+    }
 )